@@ -24,16 +24,28 @@ upload_protocol = env.subst("$UPLOAD_PROTOCOL") or "picotool"
 ram_size = 256 * 1024 # not the 264K, which is 256K SRAM + 2*4K SCRATCH(X/Y). 
 
 FRAMEWORK_DIR = platform.get_package_dir("framework-arduinopico")
-assert os.path.isdir(FRAMEWORK_DIR)
+assert os.path.isdir(FRAMEWORK_DIR), FRAMEWORK_DIR
+
+# frequently used framework subdirectories
+CORE_DIR = os.path.join(FRAMEWORK_DIR, "cores", "rp2040")
+LIB_DIR = os.path.join(FRAMEWORK_DIR, "lib")
+LIBRARIES_DIR = os.path.join(FRAMEWORK_DIR, "libraries")
+LIBPICO_DIR = os.path.join(FRAMEWORK_DIR, "tools", "libpico")
+SDK_SRC_DIR = os.path.join(FRAMEWORK_DIR, "pico-sdk", "src")
+
+# fallback USB VID/PID if the board does not specify build.hwids
+HWIDS_DEFAULT = (("0x2E8A", "0x00C0"),)
+
+# source file extensions compiled by BuildLibrary (PlatformIO's SRC_BUILD_EXT)
+SRC_BUILD_EXT = (".c", ".cc", ".cpp", ".cxx", ".c++",
+                 ".S", ".spp", ".SPP", ".sx", ".s", ".asm", ".ASM")
 
 # update progsize expression to also check for bootloader.
 env.Replace(
-    SIZEPROGREGEXP=r"^(?:\.boot2|\.text|\.data|\.rodata|\.text.align|\.ARM.exidx)\s+(\d+).*"
+    SIZEPROGREGEXP=r"^\.(?:boot2|text|data|rodata|text\.align|ARM\.exidx)\s+(\d+)"
 )
 
 env.Append(
-    ASFLAGS=env.get("CCFLAGS", [])[:],
-
     CCFLAGS=[
         "-Os",
         "-Werror=return-type",
@@ -42,8 +54,17 @@ env.Append(
         "-mthumb",
         "-ffunction-sections",
         "-fdata-sections",
-        "-iprefix" + os.path.join(FRAMEWORK_DIR),
-        "@%s" % os.path.join(FRAMEWORK_DIR, "lib", "platform_inc.txt")
+        "-iprefix" + FRAMEWORK_DIR,
+        "@%s" % os.path.join(LIB_DIR, "platform_inc.txt")
+    ]
+)
+
+env.Append(
+    # assembler gets the complete set of CCFLAGS from above,
+    # plus the include paths needed by the .S files.
+    ASFLAGS=list(env["CCFLAGS"]) + [
+        "-I", os.path.join(SDK_SRC_DIR, "rp2040", "hardware_regs", "include"),
+        "-I", os.path.join(SDK_SRC_DIR, "common", "pico_binary_info", "include")
     ],
 
     CFLAGS=[
@@ -60,21 +81,20 @@ env.Append(
         ("ARDUINO", 10810),
         "ARDUINO_ARCH_RP2040",
         ("F_CPU", "$BOARD_F_CPU"),
-        ("BOARD_NAME", '\\"%s\\"' % env.subst("$BOARD")),
+        ("BOARD_NAME", '\\"${BOARD}\\"'),
     ],
 
     CPPPATH=[
-        os.path.join(FRAMEWORK_DIR, "cores", "rp2040"),
-        os.path.join(FRAMEWORK_DIR, "cores", "rp2040", "api", "deprecated"),
-        os.path.join(FRAMEWORK_DIR, "cores", "rp2040",
-                     "api", "deprecated-avr-comp")
+        CORE_DIR,
+        os.path.join(CORE_DIR, "api", "deprecated"),
+        os.path.join(CORE_DIR, "api", "deprecated-avr-comp")
     ],
 
     LINKFLAGS=[
         "-march=armv6-m",
         "-mcpu=cortex-m0plus",
         "-mthumb",
-        "@%s" % os.path.join(FRAMEWORK_DIR, "lib", "platform_wrap.txt"),
+        "@%s" % os.path.join(LIB_DIR, "platform_wrap.txt"),
         "-u_printf_float",
         "-u_scanf_float",
         # no cross-reference table, heavily spams the output
@@ -85,7 +105,7 @@ env.Append(
         "-Wl,--warn-common"
     ],
 
-    LIBSOURCE_DIRS=[os.path.join(FRAMEWORK_DIR, "libraries")],
+    LIBSOURCE_DIRS=[LIBRARIES_DIR],
 
     # do **NOT** Add lib to LIBPATH, otherwise 
     # erroneous libstdc++.a will be found that crashes! 
@@ -94,8 +114,11 @@ env.Append(
     #],
 
     # link lib/libpico.a by full path, ignore libstdc++
+    # libc is listed again after libstdc++ on purpose, to resolve the
+    # libc symbols that libstdc++ pulls in.
+    # these stay lists: Append() would add a tuple as one nested element.
     LIBS=[
-        File(os.path.join(FRAMEWORK_DIR, "lib", "libpico.a")), 
+        File(os.path.join(LIB_DIR, "libpico.a")), 
         "m", "c", "stdc++", "c"]
 )
 
@@ -103,11 +126,11 @@ env.Append(
 def configure_usb_flags(cpp_defines):
     global ram_size
     if "USE_TINYUSB" in cpp_defines:
-        env.Append(CPPPATH=[os.path.join(
-            FRAMEWORK_DIR, "libraries", "Adafruit_TinyUSB_Arduino", "src", "arduino")])
+        usb_include = os.path.join(
+            LIBRARIES_DIR, "Adafruit_TinyUSB_Arduino", "src", "arduino")
     elif "PIO_FRAMEWORK_ARDUINO_NO_USB" in cpp_defines:
         env.Append(
-            CPPPATH=[os.path.join(FRAMEWORK_DIR, "tools", "libpico")],
+            CPPPATH=[LIBPICO_DIR],
             CPPDEFINES=[
                 "NO_USB",
                 "DISABLE_USB_SERIAL" 
@@ -117,14 +140,14 @@ def configure_usb_flags(cpp_defines):
         return
     else:
         # standard Pico SDK USB stack used.
-        env.Append(CPPPATH=[os.path.join(FRAMEWORK_DIR, "tools", "libpico")])
+        usb_include = LIBPICO_DIR
     # in any case, add standard flags
     # preferably use USB information from arduino.earlephilhower section,
     # but fallback to sensible values derived from other parts otherwise.
-    usb_pid = board.get("build.arduino.earlephilhower.usb_pid",
-                        board.get("build.hwids", [[0, 0]])[0][1])
-    usb_vid = board.get("build.arduino.earlephilhower.usb_vid",
-                        board.get("build.hwids", [[0, 0]])[0][0])
+    # boards without build.hwids enumerate with the Raspberry Pi Pico VID/PID
+    hw_ids = board.get("build.hwids", HWIDS_DEFAULT)
+    usb_pid = board.get("build.arduino.earlephilhower.usb_pid", hw_ids[0][1])
+    usb_vid = board.get("build.arduino.earlephilhower.usb_vid", hw_ids[0][0])
     usb_manufacturer = board.get(
         "build.arduino.earlephilhower.usb_manufacturer", board.get("vendor", "Raspberry Pi"))
     usb_product = board.get(
@@ -143,31 +166,61 @@ def configure_usb_flags(cpp_defines):
         pidtouse = '0x2488'
         ram_size = 240 * 1024
 
-    env.Append(CPPDEFINES=[
+    usb_defines = [
         ("CFG_TUSB_MCU", "OPT_MCU_RP2040"),
         ("USB_VID", usb_vid),
         ("USB_PID", usb_pid),
         ("USB_MANUFACTURER", '\\"%s\\"' % usb_manufacturer),
         ("USB_PRODUCT", '\\"%s\\"' % usb_product),
         ("SERIALUSB_PID", usb_pid)
-    ])
+    ]
 
-    if "USBD_MAX_POWER_MA" not in env.Flatten(env.get("CPPDEFINES", [])):
-        env.Append(CPPDEFINES=[("USBD_MAX_POWER_MA", 500)])
+    if "USBD_MAX_POWER_MA" not in cpp_defines:
+        usb_defines.append(("USBD_MAX_POWER_MA", 500))
         print("Warning: Undefined USBD_MAX_OWER_MA, assuming 500mA")
 
+    env.Append(CPPPATH=[usb_include], CPPDEFINES=usb_defines)
+
     # use vidtouse and pidtouse 
     # for USB PID/VID autodetection
-    hw_ids = board.get("build.hwids", [["0x2E8A", "0x00C0"]])
-    hw_ids[0][0] = vidtouse
-    hw_ids[0][1] = pidtouse
-    board.update("build.hwids", hw_ids)
+    board.update("build.hwids", [[vidtouse, pidtouse]] + list(hw_ids[1:]))
     board.update("upload.maximum_ram_size", ram_size)
 
+
+def has_sources(directory):
+    # most variants only consist of a pins_arduino.h header.
+    # a missing directory has nothing to build, same as BuildLibrary.
+    if not os.path.isdir(directory):
+        return False
+    return any(
+        name.endswith(SRC_BUILD_EXT)
+        for _, _, files in os.walk(directory) for name in files)
+
+
+def generate_linkerscript(target, source, env):
+    # same substitutions as tools/simplesub.py, but done in-process
+    # to avoid spawning another Python interpreter per build.
+    substitutions = (
+        ("__FLASH_LENGTH__", env.subst("$PICO_FLASH_LENGTH")),
+        ("__EEPROM_START__", env.subst("$PICO_EEPROM_START")),
+        ("__FS_START__", env.subst("$FS_START")),
+        ("__FS_END__", env.subst("$FS_END")),
+        ("__RAM_LENGTH__", env.subst("$PICO_RAM_LENGTH")),
+    )
+    with open(source[0].get_abspath(), "r") as fin:
+        data = fin.read()
+    for find, replace in substitutions:
+        data = data.replace(find, replace)
+    with open(target[0].get_abspath(), "w") as fout:
+        fout.write(data)
+
 #
 # Process configuration flags
 #
-cpp_defines = env.Flatten(env.get("CPPDEFINES", []))
+# names of all top-level macro definitions, either bare ("NAME")
+# or valued (("NAME", value)), for constant-time feature-flag tests
+cpp_defines = set(
+    d if isinstance(d, str) else d[0] for d in env.get("CPPDEFINES", []))
 
 configure_usb_flags(cpp_defines)
 
@@ -177,68 +230,64 @@ configure_usb_flags(cpp_defines)
 # flash is usefull for debugging and the only currently working one for debugging.
 ldscript_style = board.get("build.ldscript_style", "default")
 linkerscript_name = "memmap_more_sram_only.ld" if ldscript_style == "ram" else "memmap_flash_only.ld" if ldscript_style == "flash" else "memmap_default.ld"
-print("Used linkerscript: %s" %  linkerscript_name)
-
-linkerscript_cmd = env.Command(
-    os.path.join("$BUILD_DIR", linkerscript_name),  # $TARGET
-    os.path.join(FRAMEWORK_DIR, "lib", linkerscript_name),  # $SOURCE
-    env.VerboseAction(" ".join([
-        '"$PYTHONEXE" "%s"' % os.path.join(
-            FRAMEWORK_DIR, "tools", "simplesub.py"),
-        "--input", "$SOURCE",
-        "--out", "$TARGET",
-        "--sub", "__FLASH_LENGTH__", "$PICO_FLASH_LENGTH",
-        "--sub", "__EEPROM_START__", "$PICO_EEPROM_START",
-        "--sub", "__FS_START__", "$FS_START",
-        "--sub", "__FS_END__", "$FS_END",
-        "--sub", "__RAM_LENGTH__", "%dk" % (ram_size // 1024),
-    ]), "Generating linkerscript $BUILD_DIR/%s" % linkerscript_name)
-)
+print(f"Used linkerscript: {linkerscript_name}")
 
-# if no custom linker script is provided, we use the command that we prepared to generate one.
+# if no custom linker script is provided, generate one from the template.
 if not board.get("build.ldscript", ""):
     # execute fetch filesystem info stored in env to alawys have that info ready
     env["fetch_fs_size"](env)
+    env.Replace(PICO_RAM_LENGTH="%dk" % (ram_size // 1024))
+    linkerscript_cmd = env.Command(
+        os.path.join("$BUILD_DIR", linkerscript_name),  # $TARGET
+        os.path.join(LIB_DIR, linkerscript_name),  # $SOURCE
+        # function actions do not track the construction variables they
+        # read, list them so the linkerscript is rebuilt when they change.
+        env.Action(generate_linkerscript,
+                   "Generating linkerscript $BUILD_DIR/%s" % linkerscript_name,
+                   varlist=["PICO_FLASH_LENGTH", "PICO_EEPROM_START",
+                            "FS_START", "FS_END", "PICO_RAM_LENGTH"])
+    )
     env.Depends("$BUILD_DIR/${PROGNAME}.elf", linkerscript_cmd)
     env.Replace(LDSCRIPT_PATH=os.path.join("$BUILD_DIR", linkerscript_name))
 
-libs = []
-
 variant = board.get("build.arduino.earlephilhower.variant", board.get("build.variant", ""))
 
 if variant != "":
-    env.Append(CPPPATH=[
-        os.path.join(FRAMEWORK_DIR, "variants", variant)
-    ])
+    variant_dir = os.path.join(FRAMEWORK_DIR, "variants", variant)
+    env.Append(CPPPATH=[variant_dir])
+
+# canonicalize the order of macro definitions so that the framework
+# objects get identical command lines (and cache signatures) across builds.
+env.Replace(CPPDEFINES=sorted(
+    env.get("CPPDEFINES", []),
+    key=lambda d: d[0] if isinstance(d, (tuple, list)) else d))
+# drop duplicate include paths, keeping the first occurrence of each.
+# flag lists are left alone, they contain positional pairs like "-I", dir.
+env.Replace(CPPPATH=list(dict.fromkeys(env.get("CPPPATH", []))))
 
+libs = []
+
+if variant != "" and has_sources(variant_dir):
     libs.append(
         env.BuildLibrary(
             os.path.join("$BUILD_DIR", "FrameworkArduinoVariant"),
-            os.path.join(FRAMEWORK_DIR, "variants", variant)))
+            variant_dir))
 
 libs.append(
     env.BuildLibrary(
         os.path.join("$BUILD_DIR", "FrameworkArduino"),
-        os.path.join(FRAMEWORK_DIR, "cores", "rp2040")))
+        CORE_DIR))
 
 bootloader_src_file = board.get(
     "build.arduino.earlephilhower.boot2_source", "boot2_generic_03h_2_padded_checksum.S")
 
 # Add bootloader file (boot2.o)
-# Only build the needed .S file, exclude all others via src_filter.
+# Only build the needed .S file, the filter starts out empty so a single
+# include pattern is enough.
 env.BuildSources(
     os.path.join("$BUILD_DIR", "FrameworkArduinoBootloader"),
     os.path.join(FRAMEWORK_DIR, "boot2"),
-    "-<*> +<%s>" % bootloader_src_file,
-)
-# Add include flags for all .S assembly file builds
-env.Append(
-    ASFLAGS=[
-        "-I", os.path.join(FRAMEWORK_DIR, "pico-sdk", "src",
-                           "rp2040", "hardware_regs", "include"),
-        "-I", os.path.join(FRAMEWORK_DIR, "pico-sdk", "src",
-                           "common", "pico_binary_info", "include")
-    ]
+    "+<%s>" % bootloader_src_file,
 )
 
 env.Prepend(LIBS=libs)
\ No newline at end of file